@@ -16,11 +16,19 @@ setup(
     license='GPLv3',
     package_dir={"": "src"},
     packages=["redicts"],
+    python_requires=">=3.3",
     setup_requires=[],
+    extras_require={
+        # Faster (de)serialization of values:
+        "orjson": ["orjson"],
+        # C parser for redis replies, picked up by redis-py automatically:
+        "hiredis": ["hiredis"],
+    },
     tests_require=['pytest', 'pytest-runner'],
     long_description=read("README.rst"),
     classifiers=[
         "Development Status :: 4 - Beta",
+        "Programming Language :: Python :: 3",
         "Topic :: Database",
         "Topic :: Software Development :: Libraries :: Python Modules",
     ]
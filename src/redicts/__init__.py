@@ -49,5 +49,5 @@ __version__ = '1.0.0'
 
 # pylint: disable=unused-import
 from redicts.proxy import section, root, Pool, Proxy
-from redicts.lock import Lock
+from redicts.lock import Lock, MultiLock
 from redicts.errors import LockTimeout, InternalError
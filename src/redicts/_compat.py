@@ -6,17 +6,86 @@ Compatibility helpers.
 """
 
 # Stdlib:
-import sys
+import json
+import re
 
-# External:
-import six
+# External (optional):
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
-def _to_native(val, charset=sys.getdefaultencoding(), errors='strict'):
-    """Convery a unicode (py2.7) or bytes (py3) to a str without hassle."""
+if orjson is not None:
+    # orjson writes the same JSON as json, just a lot faster, with two
+    # exceptions: it refuses integers beyond 64 bit and it writes NaN and
+    # Infinity as null. Values like that are left to json.
+    # Note that the checks below have to stay cheap (i.e. in C), otherwise
+    # they eat up all that orjson saves.
+
+    # When reading, orjson turns integers beyond 64 bit into floats and
+    # rejects NaN and Infinity. Anything with a run of 19 digits or more
+    # might be such an integer and is left to json as well. To find those
+    # runs quickly, all digits are mapped to '0' and everything else to '.'.
+    _DIGIT_MASK = bytes(
+        ord('0') if ord('0') <= char <= ord('9') else ord('.')
+        for char in range(256)
+    )
+    _LONG_NUMBER = b'0' * 19
+
+    def json_dumps(value):
+        """Serialize `value` to JSON (as bytes or str)."""
+        try:
+            data = orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS)
+        except orjson.JSONEncodeError:
+            return json.dumps(value)
+
+        # NaN and Infinity turn into null. If there is any null, check if
+        # it reads back as the same value (both steps happen in C).
+        if b'null' in data and orjson.loads(data) != value:
+            return json.dumps(value)
+
+        return data
+
+    def json_loads(value):
+        """Deserialize the JSON string (or bytes) `value`."""
+        data = value.encode('utf-8') if isinstance(value, str) else value
+        if len(data) >= len(_LONG_NUMBER) and \
+                _LONG_NUMBER in data.translate(_DIGIT_MASK):
+            return json.loads(value)
+
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # NaN and Infinity; json raises as well if it is really invalid.
+            return json.loads(value)
+else:
+    # Plain integers are very common (counters), handle them without the
+    # json module. Their JSON form is the same as str() and int() read it.
+    # Note that str.isdigit() is also true for non-ASCII digits.
+    _DIGITS_MATCH = re.compile(r'[0-9]+\Z').match
+
+    def json_dumps(value):
+        """Serialize `value` to JSON (as str)."""
+        if type(value) is int:  # pylint: disable=unidiomatic-typecheck
+            return str(value)
+
+        return json.dumps(value)
+
+    def json_loads(value):
+        """Deserialize the JSON string (or bytes) `value`."""
+        if isinstance(value, bytes):
+            value = value.decode('utf-8')
+
+        if _DIGITS_MATCH(value):
+            return int(value)
+
+        return json.loads(value)
+
+
+def _to_native(val, errors='strict'):
+    """Convert bytes (e.g. from a non-decoding connection) to a str."""
     if val is None or isinstance(val, str):
         return val
 
-    if six.PY3:
-        return val.decode(charset, errors)
-    return val.encode(charset, errors)
+    return val.decode('utf-8', errors)
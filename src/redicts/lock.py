@@ -2,13 +2,16 @@
 # -*- coding: utf-8 -*-
 
 """
-Optimistic, distribured lock implementation.
+Distributed, hierarchical lock implementation.
 """
 
 # Stdlib:
 import os
-import time
+import random
 import threading
+import weakref
+
+from time import monotonic
 
 # External:
 import redis
@@ -20,10 +23,245 @@ from redicts._compat import _to_native
 from redicts.errors import LockTimeout, InternalError
 
 
+# Released locks are announced on this channel (+ the lock key), so waiters
+# can wake up immediately instead of polling the lock key:
+UNLOCK_CHANNEL_PREFIX = 'redicts:unlock:'
+
+# Bounds (in seconds) for waiting on a release notification.
+# The wait time doubles on every retry and gets a random jitter on top,
+# so waiters of an expired lock do not retry all at the same time.
+_MIN_WAIT_SECONDS = 0.001
+_MAX_WAIT_SECONDS = 0.1
+
+# Waiters do not subscribe themselves. One listener per connection pool
+# subscribes to all release notifications and wakes up the waiters of a key.
+# It stops (and gives back its connection) after being idle for this long:
+_LISTENER_IDLE_SECONDS = 10
+
+# How long the listener blocks on reading before it checks if it is idle:
+_LISTENER_POLL_SECONDS = 1
+
+# Connection pool (or connection) -> its _UnlockListener.
+_UNLOCK_LISTENERS = weakref.WeakKeyDictionary()
+_UNLOCK_LISTENERS_LOCK = threading.Lock()
+
+# Status codes returned by the scripts below:
+_STATUS_BAD_TOKEN = -1
+_STATUS_LOCKED_BY_OTHER = 0
+_STATUS_OK = 1
+
+_STATUS_CODES = {
+    'bad_token': _STATUS_BAD_TOKEN,
+    'locked_by_other': _STATUS_LOCKED_BY_OTHER,
+    'ok': _STATUS_OK,
+}
+
+# Both scripts get the key hierarchies of one or more locks as KEYS
+# (each one with the own key first and the root last) and as ARGV the pid,
+# thread ident and expire seconds of the caller, the channel prefix used to
+# announce a release and the number of keys in each hierarchy.
+# They return a status code and the key they worked on.
+# Note: The scripts are %-formatted with the status codes.
+_FIND_ROOT_FUNCTION = """
+local function find_root(first, last)
+    for i = first, last do
+        local token = redis.call('GET', KEYS[i])
+        if token then
+            return KEYS[i], token
+        end
+    end
+    return KEYS[first], nil
+end
+"""
+
+_ACQUIRE_SCRIPT = _FIND_ROOT_FUNCTION + """
+-- Check all locks first, so nothing changes if one of them is taken.
+local first = 1
+for i = 5, #ARGV do
+    local last = first + tonumber(ARGV[i]) - 1
+    local key, token = find_root(first, last)
+    if token then
+        local pid, tid, count = string.match(token, '^(%%d+):(%%d+):(%%d+)$')
+        if not count then
+            return {%(bad_token)d, key}
+        end
+
+        if pid ~= ARGV[1] or tid ~= ARGV[2] then
+            return {%(locked_by_other)d, key}
+        end
+    end
+    first = last + 1
+end
+
+-- All of them are free or our own (recursive) locks: increment the count.
+first = 1
+for i = 5, #ARGV do
+    local last = first + tonumber(ARGV[i]) - 1
+    local key, token = find_root(first, last)
+    local count = 0
+    if token then
+        count = tonumber(string.match(token, '(%%d+)$'))
+    end
+
+    redis.call('SETEX', key, tonumber(ARGV[3]),
+               ARGV[1] .. ':' .. ARGV[2] .. ':' .. (count + 1))
+    first = last + 1
+end
+
+return {%(ok)d, KEYS[1]}
+""" % _STATUS_CODES
+
+_RELEASE_SCRIPT = _FIND_ROOT_FUNCTION + """
+local first = 1
+for i = 5, #ARGV do
+    local last = first + tonumber(ARGV[i]) - 1
+    local key, token = find_root(first, last)
+    if token then
+        local pid, tid, count = string.match(token, '^(%%d+):(%%d+):(%%d+)$')
+        count = tonumber(count)
+        if not count or count <= 0 then
+            return {%(bad_token)d, key}
+        end
+
+        if pid ~= ARGV[1] or tid ~= ARGV[2] then
+            -- Our lock expired and someone else took it over (validly).
+            -- Leave it alone.
+        elseif count == 1 then
+            redis.call('DEL', key)
+            redis.call('PUBLISH', ARGV[4] .. key, 1)
+        else
+            redis.call('SETEX', key, tonumber(ARGV[3]),
+                       ARGV[1] .. ':' .. ARGV[2] .. ':' .. (count - 1))
+        end
+    end
+    first = last + 1
+end
+
+return {%(ok)d, KEYS[1]}
+""" % _STATUS_CODES
+
+
+class _UnlockListener(object):
+    """Share a single subscription to all release notifications between
+    all waiting threads of a process.
+
+    Each watched key has an event that is set (and replaced by a fresh one)
+    when a release of the key is announced. A waiter has to fetch the event
+    before checking the lock, otherwise it might miss the release.
+    """
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._pubsub = None
+
+        # Key -> [current event, number of watchers]
+        self._watched = {}
+
+    def watch(self, redis_conn, key):
+        """Start watching `key` for releases.
+
+        :param redis_conn: (redis.StrictRedis) Used to subscribe if the
+            listener is not running yet.
+        :param key: (str) The lock key to watch.
+        """
+        with self._lock:
+            entry = self._watched.setdefault(key, [threading.Event(), 0])
+            entry[1] += 1
+
+            if self._pubsub is None:
+                self._pubsub = redis_conn.pubsub(
+                    ignore_subscribe_messages=True
+                )
+                self._pubsub.psubscribe(UNLOCK_CHANNEL_PREFIX + '*')
+
+                thread = threading.Thread(
+                    target=self._listen, args=(self._pubsub, )
+                )
+                thread.daemon = True
+                thread.start()
+
+    def unwatch(self, key):
+        """Stop watching `key` again (once for each call of watch).
+
+        :param key: (str) The lock key to forget.
+        """
+        with self._lock:
+            entry = self._watched[key]
+            entry[1] -= 1
+            if entry[1] <= 0:
+                del self._watched[key]
+
+    def event(self, key):
+        """Return the event that is set on the next release of `key`.
+
+        :param key: (str) A key that is watched right now.
+        :returns threading.Event: The event to wait on.
+        """
+        with self._lock:
+            return self._watched[key][0]
+
+    def _listen(self, pubsub):
+        """Dispatch release notifications until idle (runs in a thread).
+
+        :param pubsub: (redis.client.PubSub) The subscription to read from.
+        """
+        idle_since = None
+        try:
+            while True:
+                message = pubsub.get_message(timeout=_LISTENER_POLL_SECONDS)
+                with self._lock:
+                    if message is not None and message['type'] == 'pmessage':
+                        key = _to_native(message['channel'])
+                        entry = self._watched.get(
+                            key[len(UNLOCK_CHANNEL_PREFIX):]
+                        )
+                        if entry is not None:
+                            entry[0].set()
+                            entry[0] = threading.Event()
+
+                    if self._watched:
+                        idle_since = None
+                    elif idle_since is None:
+                        idle_since = monotonic()
+                    elif monotonic() - idle_since >= _LISTENER_IDLE_SECONDS:
+                        break
+        except redis.RedisError:
+            # Lost the connection. Waiters fall back to polling until the
+            # next one starts watching (and thereby a new listener).
+            pass
+        finally:
+            with self._lock:
+                if self._pubsub is pubsub:
+                    self._pubsub = None
+
+            pubsub.close()
+
+
+def _unlock_listener(redis_conn):
+    """Return the release listener for the connection pool of `redis_conn`.
+
+    :param redis_conn: (redis.StrictRedis) The connection waiters use.
+    :returns _UnlockListener: The (shared) listener.
+    """
+    owner = getattr(redis_conn, "connection_pool", redis_conn)
+
+    listener = _UNLOCK_LISTENERS.get(owner)
+
+    # Threads do not survive a fork, so a child needs its own listener.
+    if listener is None or listener.pid != os.getpid():
+        with _UNLOCK_LISTENERS_LOCK:
+            listener = _UNLOCK_LISTENERS.get(owner)
+            if listener is None or listener.pid != os.getpid():
+                listener = _UnlockListener()
+                _UNLOCK_LISTENERS[owner] = listener
+
+    return listener
+
+
 class Lock(object):
     """Implement a distributed, thread-safe lock for redis.
 
-    The basics are described here: https://redis.io/topics/transactions
     This lock is more flexible than other locking implementations, since
     it supports tree-based locking by specifying a dotted path as key.
 
@@ -31,157 +269,174 @@ class Lock(object):
     will be automatically locked too. It is still possible to lock elements
     below though, but those will only add their lock to the lock above.
 
-    This implementation uses optimistic locking, i.e. retry if some of the
-    to be locked values changed.
+    The lock state is only modified by Lua scripts, which redis executes
+    atomically. See https://redis.io/commands/eval for details.
     """
-    __slots__ = ["_key", "_redis_conn", "_expire_seconds", "_acquire_seconds"]
+    __slots__ = [
+        "_key", "_key_hierarchy", "_hierarchy_sizes", "_redis_conn",
+        "_expire_seconds", "_acquire_seconds",
+    ]
 
     def __init__(self, redis_conn, key, expire_timeout=30, acquire_timeout=10):
+        """Create a new lock. This does not acquire it yet.
+
+        :param redis_conn: (redis.StrictRedis) The connection to use.
+            Many locks can (and should) share one connection object; it
+            takes a connection from its pool only while running a command.
+        :param key: (str) Dotted path of the key to lock.
+        :param expire_timeout: (int) Seconds after which a lock expires.
+        :param acquire_timeout: (int) Seconds to wait for the lock.
+        """
         # Note: This object may not have any state (counter, etc.)
         # in order to stay thread-safe. The redis connection is thread-safe.
         util.validate_key(key)
 
         self._key = key
+        self._key_hierarchy = tuple(util.build_key_hierarchy(key))
+        self._hierarchy_sizes = (len(self._key_hierarchy), )
         self._redis_conn = redis_conn
         self._expire_seconds = max(1, expire_timeout)
         self._acquire_seconds = max(1, acquire_timeout)
 
-    def _find_root_lock(self, callback, pipe, keys):
-        """Find out which parent node to lock. Take self if none is locked."""
-        # Abort this operation immediately if some of the keys
-        # we are looking at changes compared to now.
-        pipe.watch(*keys)
-
-        # See if any lock in the tree above us is already locked.
-        for key in keys:
-            if pipe.get(key) is not None:
-                # This key was locked by someone.
-                # Try to acquire lock on this (might also be our own one)
-                result = callback(pipe, key)
-                break
-        else:
-            # No key locked yet. Just lock our own key.
-            result = callback(pipe, self._key)
-
-        pipe.execute()
-        return result
-
-    def _find_root_lock_with_retries(self, callback):
-        """Find out which parent node to lock, but retry indefinitely if
-        any of the involved data changed on the remote side.
-        If the correct node could have been determined, call callback
-        to do some actual work on it.
-        """
-        keys = util.build_key_hierarchy(self._key)
-        with self._redis_conn.pipeline() as pipe:
-            while True:
-                try:
-                    return self._find_root_lock(callback, pipe, keys)
-                except redis.WatchError:
-                    # One of the watched keys changed:
-                    # Bad luck, try again.
-                    continue
-
-    def _acquire(self, pipe, key):
-        """Actual implementation of acquire(), called by _find_root_lock
+    def _run_script(self, script):
+        """Run one of the locking scripts on the key hierarchy.
 
-        :param pipe: (redis.StrictPipe) A redis pipe.
-        :param key: (str) The full key to lock.
+        :param script: (str) The Lua script to execute.
+        :returns tuple: The status code and the key the script worked on.
         """
-        retries = self._acquire_seconds * 20
-        lock_count = 0
-
-        own_pid = os.getpid()
-        own_thread_ident = threading.current_thread().ident
+        keys = self._key_hierarchy
+        args = (
+            os.getpid(),
+            threading.get_ident(),
+            self._expire_seconds,
+            UNLOCK_CHANNEL_PREFIX,
+        ) + self._hierarchy_sizes
+
+        status, key = self._redis_conn.eval(script, len(keys), *(keys + args))
+        key = _to_native(key)
+
+        # This is supposed to uncover errors in locking logic.
+        if status == _STATUS_BAD_TOKEN:
+            raise InternalError(
+                "Bad lock token or count for {} ({})".format(key, self)
+            )
 
-        while retries > 0:
-            lock_token = _to_native(pipe.get(key))
+        return status, key
 
-            # Does this lock even exist?
-            if lock_token is None:
-                break
+    def is_locked(self):
+        """Return True if this lock was already acquired by someone"""
+        tokens = self._redis_conn.mget(self._key_hierarchy)
+        return any(token is not None for token in tokens)
 
-            # Is it maybe one of our own locks?
-            pid, thread_ident, lock_count = util.parse_lock_token(lock_token)
-            if pid == own_pid and thread_ident == own_thread_ident:
-                break
+    def acquire(self):
+        """Acquire the lock and wait if needed"""
+        # Without any parents there is nothing to look at for a first
+        # acquire, so a plain SET NX is enough and cheaper than the script.
+        # If it fails (e.g. for recursive locks) use the script as usual.
+        if len(self._key_hierarchy) == 1 and self._redis_conn.set(
+                self._key, util.build_lock_token(1),
+                ex=self._expire_seconds, nx=True):
+            return
 
-            # Cannot lock now. Wait a short time before a retry.
-            time.sleep(0.05)
-            retries -= 1
+        deadline = monotonic() + self._acquire_seconds
+        wait_seconds = _MIN_WAIT_SECONDS
+        listener, watched, event = None, None, None
 
-        if retries is 0:
-            raise LockTimeout(
-                "Lock timed out after {} retries".format(
-                    self._acquire_seconds * 20
-                )
-            )
+        try:
+            while True:
+                if watched is not None:
+                    event = listener.event(watched)
+
+                status, key = self._run_script(_ACQUIRE_SCRIPT)
+                if status == _STATUS_OK:
+                    return
+
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    raise LockTimeout(
+                        "Lock timed out after {} seconds".format(
+                            self._acquire_seconds
+                        )
+                    )
+
+                # Cannot lock now. Wait until the holder announces the
+                # release (or until the wait time is over, in case the lock
+                # expired or the announcement got lost).
+                if key != watched:
+                    if listener is None:
+                        listener = _unlock_listener(self._redis_conn)
+
+                    if watched is not None:
+                        listener.unwatch(watched)
+
+                    listener.watch(self._redis_conn, key)
+                    watched = key
+
+                    # The lock might have been released before we watched.
+                    continue
 
-        # Take over and make sure the key expires at some time.
-        # Also increment the lock count.
-        pipe.multi()
-        pipe.set(key, util.build_lock_token(lock_count + 1))
-        if self._expire_seconds is not None:
-            pipe.expire(key, self._expire_seconds)
+                jitter = random.uniform(0, wait_seconds)
+                event.wait(min(wait_seconds + jitter, remaining))
+                wait_seconds = min(wait_seconds * 2, _MAX_WAIT_SECONDS)
+        finally:
+            if watched is not None:
+                listener.unwatch(watched)
 
-    def _release(self, pipe, key):
-        """Actual implementation of release(), called by _find_root_lock
+    def release(self):
+        """Release the lock again.
 
-        :param pipe: (redis.Pipe) A redis pipe.
-        :param key: (str) The full key to release.
+        If the lock does not exist anymore it either expired (okay) or
+        release was called without prior acquire (which is pretty bad).
+        We can't really tell, so nothing happens in this case.
+        The same goes for a lock that is held by someone else, which
+        happens when our lock expired and was acquired by another owner.
         """
-        lock_token = _to_native(pipe.get(key))
-        if lock_token is None:
-            # This lock token does not exist anymore. This either means
-            # it expired (okay) or release was called without prior acquire
-            # (which is pretty bad). We can't really tell, so just return.
-            return
+        self._run_script(_RELEASE_SCRIPT)
+
+    def __enter__(self):
+        self.acquire()
+        return self
 
-        # We could also check if pid and thread_ident is the same as own,
-        # but that might fail on edge cases where the key expired and
-        # another pid/thread got the lock (validly). We don't check here
-        # since we cannot know for sure.
-        _, _, lock_count = util.parse_lock_token(lock_token)
+    def __exit__(self, *_exc):
+        self.release()
 
-        pipe.multi()
 
-        # These exceptions are supposed to uncover errors in locking logic.
-        if lock_count <= 0:
-            raise InternalError(
-                "Negative or zero lock count ({}) for {} ({})".format(
-                    lock_count, key, self
-                )
-            )
+class MultiLock(Lock):
+    """Lock several keys at once.
 
-        if lock_count == 1:
-            # Remove the key; we're not locking it anymore.
-            pipe.delete(key)
-        else:
-            # We held an recursive lock. Leave our mark.
-            pipe.set(key, util.build_lock_token(lock_count - 1))
-            if self._expire_seconds is not None:
-                pipe.expire(key, self._expire_seconds)
+    Either all keys get locked or none, all in a single round trip per
+    attempt. This is cheaper than acquiring many single locks one after
+    another and it cannot deadlock with another MultiLock taking the same
+    keys in a different order.
 
-    def is_locked(self):
-        """Return True if this lock was already acquired by someone"""
-        def _is_locked(pipe, key):
-            """Actual implementation of is_locked"""
-            lock_value = _to_native(pipe.get(key))
-            return lock_value is not None
+    Keys may overlap (e.g. "a" and "a.b"); they behave exactly like
+    acquiring single locks for each of them in the given order.
+    """
+    __slots__ = []
 
-        return self._find_root_lock_with_retries(_is_locked)
+    def __init__(self, redis_conn, keys, expire_timeout=30,
+                 acquire_timeout=10):
+        """Create a new lock for many keys. This does not acquire it yet.
 
-    def acquire(self):
-        """Acquire the lock and wait if needed"""
-        return self._find_root_lock_with_retries(self._acquire)
+        :param redis_conn: (redis.StrictRedis) The connection to use.
+        :param keys: (iterable) Dotted paths of the keys to lock.
+        :param expire_timeout: (int) Seconds after which the locks expire.
+        :param acquire_timeout: (int) Seconds to wait for the locks.
+        """
+        keys = list(keys)
+        if not keys:
+            raise ValueError("Need at least one key to lock")
 
-    def release(self):
-        """Release the lock again"""
-        return self._find_root_lock_with_retries(self._release)
+        super(MultiLock, self).__init__(
+            redis_conn, keys[0],
+            expire_timeout=expire_timeout,
+            acquire_timeout=acquire_timeout,
+        )
 
-    def __enter__(self):
-        self.acquire()
-        return self
+        hierarchies = []
+        for key in keys:
+            util.validate_key(key)
+            hierarchies.append(tuple(util.build_key_hierarchy(key)))
 
-    def __exit__(self, *_exc):
-        self.release()
+        self._key_hierarchy = sum(hierarchies, ())
+        self._hierarchy_sizes = tuple(len(hier) for hier in hierarchies)
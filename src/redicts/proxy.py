@@ -6,21 +6,18 @@ Main proxy implementation.
 """
 
 # Stdlib:
-import json
 import operator
+import sys
 import threading
 
-from collections import defaultdict
-
 # External:
 import redis
 import fakeredis
-import six
 
 # Internal:
 import redicts.util as util
 
-from redicts._compat import _to_native
+from redicts._compat import json_dumps, json_loads
 from redicts.lock import Lock
 
 
@@ -31,7 +28,8 @@ class _Registry(object):
     """
     def __init__(self):
         self._lock = threading.RLock()
-        self._proxies = defaultdict(dict)
+        # Maps (db_name, dotted path) to the proxy:
+        self._proxies = {}
         self._rconn = None
 
     def proxy_from_registry(self, path, db_name=None, *args, **kwargs):
@@ -40,32 +38,48 @@ class _Registry(object):
 
         This function is thread-safe.
 
-        :param path: (tuple) The tuple representation of a dotted path.
+        :param path: (str|tuple) A dotted path or its tuple representation.
         :param db_name: (str) What redis db to use.
         :param rconn: (redis.Redis) The redis connection to use.
         :returns Proxy: A new or existing
         """
-        path_elems = []
-
-        if isinstance(path, six.string_types):
+        if isinstance(path, str):
             util.validate_key(path)
-            path_elems = path.split(".")
+            dotted_path, path_elems = path, None
         else:
             # Assume it is iterable or None.
+            path_elems = []
             for elem in path or []:
                 util.validate_path_element(elem)
                 path_elems.append(elem)
 
-        # Convert to tuple, so path elements stay hashable.
-        path_elems_tuple = tuple(path_elems)
+            dotted_path = '.'.join(path_elems)
+
         kwargs["db_name"] = db_name
 
+        # Proxies are stored by db and dotted path, which needs a single
+        # string hash instead of hashing every path element. Most of the time
+        # the proxy exists already. Reading a dict is atomic, so only take the
+        # lock when a new proxy is needed.
+        registry_key = (db_name, dotted_path)
+        proxy = self._proxies.get(registry_key)
+        if proxy is not None:
+            return proxy
+
+        if path_elems is None:
+            path_elems = path.split(".")
+
+        # Many proxies share the same path elements; interning them
+        # lets all of them point to the same string objects.
+        path_elems_tuple = tuple(sys.intern(elem) for elem in path_elems)
+
         with self._lock:
-            # Prefer the one passed directly.
-            return self._proxies[db_name].setdefault(
-                path_elems_tuple,
-                _Proxy(path_elems_tuple, *args, **kwargs)
-            )
+            proxy = self._proxies.get(registry_key)
+            if proxy is None:
+                proxy = _Proxy(path_elems_tuple, *args, **kwargs)
+                self._proxies[registry_key] = proxy
+
+            return proxy
 
 
 # The locking tree is separated form the value tree by a different prefix:
@@ -73,6 +87,26 @@ LOCK_TREE_PREFIX = 'l:'
 VAL_TREE_PREFIX = 'v:'
 _REGISTRY = _Registry()
 
+# Hint for how many keys SCAN should look at per call:
+SCAN_COUNT = 1000
+
+# Maximum number of keys fetched (or changed) by a single command:
+BATCH_SIZE = 1000
+
+# Adds ARGV[1] to the float stored in KEYS[1] and returns whether the key
+# existed before and the new total. INCRBYFLOAT writes whole numbers without
+# a fraction ("3"), which would read back as int, so ".0" is appended then.
+# APPEND (like INCRBYFLOAT) keeps the expire time of the key.
+_ADD_FLOAT_SCRIPT = """
+local existed = redis.call('EXISTS', KEYS[1])
+local total = redis.call('INCRBYFLOAT', KEYS[1], tonumber(ARGV[1]))
+if not string.find(total, '[%.eEn]') then
+    redis.call('APPEND', KEYS[1], '.0')
+    total = total .. '.0'
+end
+return {existed, total}
+"""
+
 
 def _op_proxy(oper):
     """Redirect a python operator to the .val() method of Proxy
@@ -83,21 +117,68 @@ def _op_proxy(oper):
     """
     def _operator(self, *args):
         """This function is called instead of the operator in question"""
-        return oper(self.val(), *[arg.val() for arg in args])
+        # pylint: disable=protected-access
+        proxies = (self, ) + args
+        if any(prox._db_name != self._db_name for prox in proxies):
+            return oper(*[prox.val() for prox in proxies])
+
+        # Compared values are mostly scalars, so fetch all of them with a
+        # single MGET. Only nested (or missing) values need a full val().
+        raw_values = self._conn().mget(
+            [prox._get_full_key(None) for prox in proxies]
+        )
+
+        values = [
+            prox.val() if raw_value is None else json_loads(raw_value)
+            for prox, raw_value in zip(proxies, raw_values)
+        ]
+        return oper(*values)
     return _operator
 
 
+def _scan_batches(conn, pattern, last_key=None):
+    """Yield all keys matching `pattern` in lists, one list per SCAN call.
+    The lists can be passed on to commands like MGET or DEL as they are.
+
+    :param conn: (redis.Redis) The connection to redis.
+    :param pattern: (str) A glob-style pattern.
+    :param last_key: (str) Optional key to append to the last list.
+    """
+    cursor = 0
+    while True:
+        cursor, keys = conn.scan(cursor, match=pattern, count=SCAN_COUNT)
+        if not cursor:
+            break
+
+        if keys:
+            yield keys
+
+    if last_key is not None:
+        keys.append(last_key)
+
+    if keys:
+        yield keys
+
+
 def _get_sub_keys(conn, full_key):
-    """Helper to yield all sub keys including the own key.
-    Useful to
+    """Helper to yield all sub keys including the own key (as last key).
+    The keys are yielded in lists, see _scan_batches().
 
-    :param conn: (ConnectionPool) Where to get the connection from.
+    :param conn: (redis.Redis) The connection to redis.
     :param full_key: (str)
     """
-    for redis_key in conn.scan_iter(full_key + ".*"):
-        yield _to_native(redis_key)
+    return _scan_batches(conn, full_key + ".*", last_key=full_key)
+
 
-    yield _to_native(full_key)
+def _delete_sub_keys(conn, full_key):
+    """Delete a key and all of its sub keys.
+    The keys are deleted in batches, one DEL command per SCAN call.
+
+    :param conn: (redis.Redis) The connection to redis.
+    :param full_key: (str)
+    """
+    for batch in _get_sub_keys(conn, full_key):
+        conn.delete(*batch)
 
 
 def _clear_all_locks(rconn):
@@ -106,9 +187,7 @@ def _clear_all_locks(rconn):
 
     :param rconn: (redis.Redis) The connection to redis.
     """
-    rconn.delete(LOCK_TREE_PREFIX)
-    for redis_key in rconn.scan_iter(LOCK_TREE_PREFIX + ".*"):
-        rconn.delete(redis_key)
+    _delete_sub_keys(rconn, LOCK_TREE_PREFIX)
 
 
 class _Proxy(object):
@@ -116,7 +195,10 @@ class _Proxy(object):
     See the module description for a more detailed description
     and some additional usage examples.
     """
-    __slots__ = ["_path", "_redis_lock", "_db_name"]
+    __slots__ = [
+        "_path", "_key", "_full_key", "_lock_cache", "_lock_timeouts",
+        "_db_name", "_conn_cache",
+    ]
 
     def __init__(self, path, lock_acquire_timeout=10,
                  lock_expire_timeout=30, db_name=None):
@@ -128,27 +210,57 @@ class _Proxy(object):
         :param lock_expire_timeout: int (seconds)Passed to Lock().
         :param db_name: (str) Optional db_name to use (uses default otherwise)
         """
-        if isinstance(path, six.string_types):
+        if isinstance(path, str):
             path = (path, )
 
         self._path = tuple(path)
+        self._key = '.'.join(self._path)
+        self._full_key = '.'.join((VAL_TREE_PREFIX, ) + self._path)
         self._db_name = db_name
+        self._conn_cache = (None, None)
 
-        self._redis_lock = Lock(
-            self._conn(),
-            '.'.join((LOCK_TREE_PREFIX, ) + self._path),
-            acquire_timeout=lock_acquire_timeout,
-            expire_timeout=lock_expire_timeout,
-        )
+        # Most proxies are never locked, so the Lock is created on first use.
+        self._lock_cache = (None, None)
+        self._lock_timeouts = (lock_acquire_timeout, lock_expire_timeout)
 
     def _conn(self):
-        """Return a pooled connection for the right database"""
-        return Pool().get_connection(self._db_name)
+        """Return a pooled connection for the right database.
+        The connection is cached until the Pool gets reloaded.
+        """
+        pool = Pool()
+        current = pool.generation
+        generation, conn = self._conn_cache
+        if generation != current:
+            conn = pool.get_connection(self._db_name)
+            self._conn_cache = (current, conn)
+
+        return conn
 
     ##########################
     # LOCKING IMPLEMENTATION #
     ##########################
 
+    @property
+    def _redis_lock(self):
+        """The Lock of this proxy, created when it is needed first.
+        Like the connection it uses, it is renewed when the Pool gets reloaded.
+        """
+        current = Pool().generation
+        generation, lock = self._lock_cache
+        if generation != current:
+            # Two threads might both create one here, which is fine:
+            # locks keep no state besides their configuration.
+            acquire_timeout, expire_timeout = self._lock_timeouts
+            lock = Lock(
+                self._conn(),
+                '.'.join((LOCK_TREE_PREFIX, ) + self._path),
+                acquire_timeout=acquire_timeout,
+                expire_timeout=expire_timeout,
+            )
+            self._lock_cache = (current, lock)
+
+        return lock
+
     def is_locked(self):
         """Check if the node or any of its parents are locked"""
         return self._redis_lock.is_locked()
@@ -183,24 +295,18 @@ class _Proxy(object):
                         will be built.
         :returns str: The fully qualified path of this node.
         """
-        if self._path:
-            own_key = '.'.join((VAL_TREE_PREFIX, ) + self._path)
-        else:
-            own_key = VAL_TREE_PREFIX
-
         if key is not None:
-            return own_key + '.' + key
+            return self._full_key + '.' + key
 
-        return own_key
+        return self._full_key
 
     def key(self):
         """Return the key of this value in redis"""
-        return '.'.join(self._path)
+        return self._key
 
     def clear(self):
         """Clear this level of the value tree including all children"""
-        for redis_key in _get_sub_keys(self._conn(), self._get_full_key(None)):
-            self._conn().delete(redis_key)
+        _delete_sub_keys(self._conn(), self._get_full_key(None))
 
     def exists(self):
         """Return true if this value actually exists"""
@@ -220,13 +326,35 @@ class _Proxy(object):
         :returns: A generator object, yielding ValueProxies.
         """
         own_path = self._get_full_key(None)
-        for redis_key in self._conn().scan_iter(own_path + '.*'):
-            # Split the VAL_TREE_PREFIX away, it will be added again when
-            # creating a new _Proxy.
-            trimmed_key = _to_native(redis_key[len(LOCK_TREE_PREFIX) + 1:])
-            yield _REGISTRY.proxy_from_registry(
-                trimmed_key, db_name=self._db_name
-            )
+        for batch in _scan_batches(self._conn(), own_path + '.*'):
+            for redis_key in batch:
+                # Split the VAL_TREE_PREFIX away, it will be added again when
+                # creating a new _Proxy.
+                trimmed_key = redis_key[len(LOCK_TREE_PREFIX) + 1:]
+                yield _REGISTRY.proxy_from_registry(
+                    trimmed_key, db_name=self._db_name
+                )
+
+    def iter_items(self):
+        """Like iter_children(), but yield the value of each child too.
+        The values are fetched with one MGET per batch of children,
+        instead of one GET per child.
+
+        :returns: A generator object, yielding (ValueProxy, value) tuples.
+        """
+        conn = self._conn()
+        own_path = self._get_full_key(None)
+        for batch in _scan_batches(conn, own_path + '.*'):
+            for redis_key, value in zip(batch, conn.mget(batch)):
+                # The key might have been deleted since the scan.
+                if value is None:
+                    continue
+
+                trimmed_key = redis_key[len(VAL_TREE_PREFIX) + 1:]
+                prox = _REGISTRY.proxy_from_registry(
+                    trimmed_key, db_name=self._db_name
+                )
+                yield prox, json_loads(value)
 
     def set(self, key, value, expire=None):
         """Set a new value to this key.
@@ -235,28 +363,67 @@ class _Proxy(object):
         :param value: (object) Any value that can be passed to json.dumps.
         :param expire: (int) Time in seconds when to expire this key or None.
         """
-        util.validate_key(key)
-        full_key = self._get_full_key(key)
+        return self.set_many({key: value}, expire=expire)
 
-        conn = self._conn()
+    def set_many(self, mapping, expire=None):
+        """Set new values for several keys at once.
 
-        # Delete any previous keys since we're overwriting this key.
-        # We don't want to have those old keys lying around above.
-        util.clear_parents(conn, full_key)
+        This is the same as calling set() for each item, but everything
+        (including clearing old children of nested values) happens in a
+        single transaction. If any key is invalid, nothing is changed.
+        The keys should not overlap (e.g. "a" and "a.b"), since existing
+        children are looked up before anything is written.
 
-        if isinstance(value, dict):
-            # We overwrite all children, clear any leftover keys.
-            self.get(key).clear()
-            items = util.extract_keys(value, full_key)
-        else:
-            items = ((full_key, value), )
+        :param mapping: (dict) Dotted paths mapped to their new values.
+        :param expire: (int) Time in seconds when to expire the keys or None.
+        """
+        # Validate everything before touching any data.
+        all_items = []
+        for key, value in mapping.items():
+            util.validate_key(key)
+            full_key = self._get_full_key(key)
+
+            if isinstance(value, dict):
+                items = list(util.extract_keys(value, full_key))
+            else:
+                items = [(full_key, value)]
+
+            all_items.append((full_key, isinstance(value, dict), items))
 
         # Allow floats as expire time:
         if expire is not None:
             expire = int(expire)
 
-        for full_key, value in items:
-            conn.set(full_key, json.dumps(value), ex=expire)
+        conn = self._conn()
+
+        # Old children can only be found by scanning, which is not possible
+        # inside a transaction. Find them first, delete them in it.
+        old_keys = {}
+        for full_key, is_nested, _ in all_items:
+            if is_nested:
+                old_keys[full_key] = list(_get_sub_keys(conn, full_key))
+
+        with conn.pipeline() as pipe:
+            for full_key, is_nested, items in all_items:
+                # We overwrite all children, clear any leftover keys.
+                for batch in old_keys.get(full_key, ()):
+                    pipe.delete(*batch)
+
+                # Delete any previous keys since we're overwriting this key.
+                # We don't want to have those old keys lying around above.
+                util.clear_parents(pipe, full_key)
+
+                for batch in util.iter_batches(items, BATCH_SIZE):
+                    if expire is None:
+                        pipe.mset({
+                            redis_key: json_dumps(val)
+                            for redis_key, val in batch
+                        })
+                    else:
+                        for redis_key, val in batch:
+                            pipe.set(redis_key, json_dumps(val), ex=expire)
+
+            pipe.execute()
 
         return self
 
@@ -266,38 +433,37 @@ class _Proxy(object):
         :param key: (str) A dotted path or simple
         :return: A child Proxy.
         """
-        util.validate_key(key)
-        child_path = self._path + tuple(key.split('.'))
-        return _REGISTRY.proxy_from_registry(child_path, db_name=self._db_name)
+        # Pass the dotted path on as string; the registry validates it and
+        # only needs to split it up when the child proxy is new.
+        child_key = self._key + '.' + key if self._key else key
+        return _REGISTRY.proxy_from_registry(child_key, db_name=self._db_name)
 
     def val(self, default=None):
         """Get the actual value of this proxy"""
         full_key = self._get_full_key(None)
 
         # Check if this exact key exists. If yes, it's an scalar value.
-        # This check will fail if the user set a 'None' value.
-        # See below for this case.
+        # An explicitly set None is stored as 'null', so it ends up here too.
         conn = self._conn()
-        value = _to_native(conn.get(full_key))
+        value = conn.get(full_key)
         if value is not None:
-            return json.loads(value)
+            return json_loads(value)
 
         nested = {}
-        for redis_key in conn.scan_iter(full_key + '.*'):
-            value = _to_native(conn.get(redis_key))
-
-            # Strip the full key prefix, we're only interested in returning
-            # the children values directly.
-            sub_key = _to_native(redis_key[len(full_key) + 1:])
-            util.feed_to_nested(nested, sub_key, json.loads(value))
-
-        # This is for the case that this key does not exist, or
-        # for the case that the user explicitly set a None value.
-        if len(nested) is 0:
-            # Key really does not exist.
-            if default is None and not self.exists():
-                return None
-
+        for batch in _scan_batches(conn, full_key + '.*'):
+            for redis_key, value in zip(batch, conn.mget(batch)):
+                # The key might have been deleted since the scan.
+                if value is None:
+                    continue
+
+                # Strip the full key prefix, we're only interested in
+                # returning the children values directly.
+                sub_key = redis_key[len(full_key) + 1:]
+                util.feed_to_nested(nested, sub_key, json_loads(value))
+
+        # Neither the GET nor the scan found anything: the key does not
+        # exist, no need to ask redis again.
+        if not nested:
             return default
 
         return nested
@@ -305,16 +471,73 @@ class _Proxy(object):
     def add(self, count):
         """Convinience function to add a count to this value.
         If the value did not exist yet, it will be set to count.
-        Will raise an ValueError if the key exists and does not support
-        the add operator.
+        Will raise an ValueError if the key exists and is not a number
+        and a TypeError if it is a nested value.
+
+        The addition happens atomically on the server, so no lock is needed.
+        The expire time of the value (if any) is kept.
 
-        :param count: (int) The count to increment.
+        :param count: (int|float) The count to increment.
         :return: The new total count.
         """
         full_key = self._get_full_key()
-        new_val = self.val() + count if self.exists() else count
-        self._conn().set(full_key, json.dumps(new_val))
-        return new_val
+        conn = self._conn()
+
+        existed, total = None, None
+        if not isinstance(count, float):
+            try:
+                with conn.pipeline() as pipe:
+                    existed, total = \
+                        pipe.exists(full_key).incrby(full_key, count).execute()
+            except redis.ResponseError as err:
+                # Either the stored value is not an integer (but maybe a
+                # float) or the result does not fit into 64 bit. Only use
+                # float arithmetic in the first case, so integers stay exact.
+                if not self._stores_float(conn, full_key):
+                    raise ValueError(
+                        "Cannot add {} to {}: {}".format(
+                            count, self.key(), err
+                        )
+                    )
+
+        if total is None:
+            try:
+                existed, total = conn.eval(
+                    _ADD_FLOAT_SCRIPT, 1, full_key, count
+                )
+            except redis.ResponseError as err:
+                raise ValueError(
+                    "Cannot add {} to {}: {}".format(count, self.key(), err)
+                )
+
+            total = json_loads(total)
+
+        # A nested value has no own key, so the addition just created one,
+        # which would hide the children. Undo that.
+        if not existed and next(_scan_batches(conn, full_key + '.*'), None):
+            conn.delete(full_key)
+            raise TypeError(
+                "Cannot add {} to nested value {}".format(count, self.key())
+            )
+
+        return total
+
+    @staticmethod
+    def _stores_float(conn, full_key):
+        """Check if the value stored at `full_key` is a float.
+
+        :param conn: (redis.StrictRedis) The connection to redis.
+        :param full_key: (str) The full redis key of the value.
+        :returns bool: True if it's a float.
+        """
+        raw_value = conn.get(full_key)
+        if raw_value is None:
+            return False
+
+        try:
+            return isinstance(json_loads(raw_value), float)
+        except ValueError:
+            return False
 
     def expire(self, seconds):
         """Expire (i.e. delete) the key after a certain number of seconds.
@@ -324,8 +547,12 @@ class _Proxy(object):
         :param seconds: (int) seconds after this value will no longer
                         accessible.
         """
-        for redis_key in _get_sub_keys(self._conn(), self._get_full_key(None)):
-            self._conn().expire(redis_key, seconds)
+        conn = self._conn()
+        for batch in _get_sub_keys(conn, self._get_full_key(None)):
+            with conn.pipeline(transaction=False) as pipe:
+                for redis_key in batch:
+                    pipe.expire(redis_key, seconds)
+                pipe.execute()
 
     def time_to_live(self):
         """Return the amount of seconds, this value will be accessible.
@@ -333,12 +560,11 @@ class _Proxy(object):
         :returns int: the amount to live in seconds.
         """
         own_key = self._get_full_key(None)
+        conn = self._conn()
 
-        try:
-            first_redis_key = next(_get_sub_keys(self._conn(), own_key))
-            return self._conn().ttl(first_redis_key)
-        except StopIteration:
-            return None
+        # The own key always comes last, so there is at least one batch.
+        first_batch = next(_get_sub_keys(conn, own_key))
+        return conn.ttl(first_batch[0])
 
     # Support dict like access:
     def __getitem__(self, key):
@@ -354,7 +580,26 @@ class _Proxy(object):
         return iter(self.val())
 
     def __len__(self):
-        return len(self.val())
+        # Same as len(self.val()), but for nested values only the names
+        # of the direct children are needed, not their values.
+        full_key = self._get_full_key(None)
+        conn = self._conn()
+
+        value = conn.get(full_key)
+        if value is not None:
+            return len(json_loads(value))
+
+        offset = len(full_key) + 1
+        children = set()
+        for batch in _scan_batches(conn, full_key + '.*'):
+            children.update(
+                redis_key[offset:].partition('.')[0] for redis_key in batch
+            )
+
+        if not children:
+            raise TypeError("{} has no value".format(self.key()))
+
+        return len(children)
 
     __eq__ = _op_proxy(operator.eq)
     __ne__ = _op_proxy(operator.ne)
@@ -386,12 +631,16 @@ def _connection_pool_from_cfg(cfg, db_name=None):
         max_connections=cfg.get("max_connections", 100),
         timeout=cfg.get("timeout_secs", 50),
         db=db_id,
+        decode_responses=True,
     )
 
 
-@six.add_metaclass(util.Singleton)
-class Pool(object):
-    """Pool of redis connections"""
+class Pool(object, metaclass=util.Singleton):
+    """Pool of redis connections.
+
+    All connections decode responses to str, so no manual decoding
+    of the returned values is needed.
+    """
     def __init__(self, cfg=None):
         """Create a new pool.
 
@@ -410,12 +659,13 @@ class Pool(object):
 
             If any keys are missing, the default is taken over.
         """
-        self._pool_lock = threading.RLock()
+        self._pool_lock = threading.Lock()
 
         with self._pool_lock:
             self._cfg = cfg or {}
             self._pools = {}
             self._fake_redis = False
+            self._generation = 0
 
     def reload(self, cfg=None, fake_redis=False):
         """Reload the pool, disconnecting previous connections
@@ -428,12 +678,20 @@ class Pool(object):
             self._cfg = cfg or {}
             for name, pool in self._pools.items():
                 pool.disconnect()
-                if fake_redis is False:
+                if not fake_redis:
                     new_pools[name] = \
                         _connection_pool_from_cfg(self._cfg, name)
 
             self._pools = new_pools
             self._fake_redis = fake_redis
+            self._generation += 1
+
+    @property
+    def generation(self):
+        """Number of times this pool was reloaded.
+        Connections taken before the last reload should not be used anymore.
+        """
+        return self._generation
 
     def get_connection(self, db_name=None):
         """Get a new (or recycled) connection.
@@ -441,15 +699,20 @@ class Pool(object):
 
         :return redis.StrictRedis: A new redis connection.
         """
-        with self._pool_lock:
-            if self._fake_redis:
-                return fakeredis.FakeStrictRedis()
+        if self._fake_redis:
+            return fakeredis.FakeStrictRedis(decode_responses=True)
 
-            if db_name not in self._pools:
-                self._pools[db_name] = \
-                    _connection_pool_from_cfg(self._cfg, db_name)
+        # Connection pools are thread-safe themselves, so the lock is only
+        # needed when a new pool for this db_name has to be created.
+        pool = self._pools.get(db_name)
+        if pool is None:
+            with self._pool_lock:
+                pool = self._pools.get(db_name)
+                if pool is None:
+                    pool = _connection_pool_from_cfg(self._cfg, db_name)
+                    self._pools[db_name] = pool
 
-            return redis.StrictRedis(connection_pool=self._pools[db_name])
+        return redis.StrictRedis(connection_pool=pool)
 
 
 #######################
@@ -467,7 +730,7 @@ class _ProxyMeta(type):
         return _REGISTRY.proxy_from_registry(*args, **kwargs)
 
 
-class Proxy(six.with_metaclass(_ProxyMeta, _Proxy)):
+class Proxy(_Proxy, metaclass=_ProxyMeta):
     """Create a new Proxy.
 
     :param path str_or_iterable: The path where this value is stored.
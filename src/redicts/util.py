@@ -8,21 +8,34 @@ General utils, mostly for handling dotted key paths.
 
 # Stdlib:
 import os
+import re
 import threading
 
-# External:
-import six
+from functools import lru_cache
 
 # Internal:
 from redicts.errors import InternalError
 
 
+# Matches valid dotted paths: no empty elements, so no leading,
+# trailing or successive dots.
+_VALID_KEY_MATCH = re.compile(r'[^.]+(?:\.[^.]+)*\Z').match
+
+
+@lru_cache(maxsize=4096)
 def validate_key(key):
     """Check if an key is a valid dotted path
 
+    The same keys are validated over and over again,
+    so valid keys are remembered.
+
     :raises: ValueError if invalid.
     """
-    if len(key) is 0:
+    if key and _VALID_KEY_MATCH(key):
+        return
+
+    # Invalid key; find out what's wrong with it.
+    if not key:
         raise ValueError("Key or a part of it may not be empty")
 
     if key.startswith('.') or key.endswith('.'):
@@ -46,7 +59,7 @@ def validate_path_element(elem):
     :param elem: (str) A part of an dotted path (no dots allowed)
     :raises: ValueError if invalid.
     """
-    if len(elem) is 0:
+    if not elem:
         raise ValueError("Path elements may not be empty")
 
     if '.' in elem:
@@ -60,12 +73,11 @@ def build_key_hierarchy(key):
     :returns [str]: A list of keys.
     """
     all_keys = [key]
-    try:
-        while True:
-            key = key[:key.rindex('.')]
-            all_keys.append(key)
-    except ValueError:
-        pass
+    idx = key.rfind('.')
+    while idx >= 0:
+        key = key[:idx]
+        all_keys.append(key)
+        idx = key.rfind('.')
 
     return all_keys
 
@@ -79,11 +91,7 @@ def build_lock_token(count):
     :param count: (int) The lock count.
     :return str: The built token.
     """
-    return '{p}:{t}:{c}'.format(
-        p=os.getpid(),
-        t=threading.current_thread().ident,
-        c=count
-    )
+    return '%d:%d:%d' % (os.getpid(), threading.get_ident(), count)
 
 
 def parse_lock_token(token):
@@ -96,7 +104,8 @@ def parse_lock_token(token):
     if len(splitted) != 3:
         raise InternalError("Bad token: {}".format(token))
 
-    return [int(elem) for elem in splitted]
+    pid, thread_ident, lock_count = splitted
+    return int(pid), int(thread_ident), int(lock_count)
 
 
 def extract_keys(nested, prefix=""):
@@ -107,16 +116,24 @@ def extract_keys(nested, prefix=""):
     :param prefix: (str) The prefix which every yielded dotted key should have.
     :returns iter: An iterator that yields tuples of (dotted_key, value)
     """
-    for key, value in nested.items():
-        if not isinstance(key, six.string_types):
-            raise ValueError("Keys must always be strings")
-
-        redis_key = prefix + '.' + key if prefix else key
-        if isinstance(value, dict):
-            for sub in extract_keys(value, prefix=redis_key):
-                yield sub
-        else:
+    # Walk the dict with an explicit stack instead of recursion.
+    # Keeping the item iterators on the stack preserves the order of keys.
+    stack = [(prefix, iter(nested.items()))]
+    while stack:
+        prefix, items = stack[-1]
+        for key, value in items:
+            if not isinstance(key, str):
+                raise ValueError("Keys must always be strings")
+
+            redis_key = prefix + '.' + key if prefix else key
+            if isinstance(value, dict):
+                # Descend first, continue with the rest of items afterwards.
+                stack.append((redis_key, iter(value.items())))
+                break
+
             yield redis_key, value
+        else:
+            stack.pop()
 
 
 def feed_to_nested(nested, full_key, value):
@@ -137,23 +154,42 @@ def feed_to_nested(nested, full_key, value):
         # Setting these keys should not yield a TypeError for example:
         #   1) a.b.c = 2
         #   2) a.b.c.d = {"x": 3}
-        if isinstance(curr.get(key), dict) is False:
-            curr[key] = curr = {}
-        else:
-            curr = curr.setdefault(key, {})
+        child = curr.get(key)
+        if not isinstance(child, dict):
+            child = curr[key] = {}
+
+        curr = child
 
     curr[last] = value
 
 
+def iter_batches(iterable, size):
+    """Split an iterable into lists of at most `size` elements.
+
+    :param iterable: (iterable) Elements to split up.
+    :param size: (int) Maximum number of elements per batch.
+    :returns iter: An iterator that yields lists.
+    """
+    batch = []
+    for elem in iterable:
+        batch.append(elem)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
 def clear_parents(rconn, key):
     """Clear all parent keys of self.
 
     :param rconn: (redis.Redis) The connection to redis.
     :param key: (str) Dotted path of which node's parent to clear.
     """
-    parents = build_key_hierarchy(key)
-    for parent in parents[1:]:
-        rconn.delete(parent)
+    parents = build_key_hierarchy(key)[1:]
+    if parents:
+        rconn.delete(*parents)
 
 
 class Singleton(type):
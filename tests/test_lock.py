@@ -13,7 +13,7 @@ import threading
 import pytest
 
 # Internal:
-from redicts import Lock, LockTimeout
+from redicts import Lock, MultiLock, LockTimeout, InternalError
 
 
 @pytest.mark.unittest
@@ -34,6 +34,20 @@ def test_single_thread_acquire(fake_redis):
     assert not mtx.is_locked()
 
 
+@pytest.mark.unittest
+def test_recursive_acquire(fake_redis):
+    """Test if the same thread can acquire the lock more than once"""
+    mtx = Lock(fake_redis, 'dum-dum')
+
+    with mtx:
+        with mtx:
+            assert mtx.is_locked()
+
+        assert mtx.is_locked()
+
+    assert not mtx.is_locked()
+
+
 @pytest.mark.unittest
 def test_acquire_timeout(fake_redis):
     """Test if a threaded double acquire actually blocks"""
@@ -67,28 +81,154 @@ def test_acquire_expire(fake_redis):
     mtx = Lock(fake_redis, 'dum-dum', expire_timeout=1)
     mtx.acquire()
 
-    # This is only a dict to make it
-    # possible to modify it in another thread.
-    checks = {
-        "thread_acquired": False,
-        "thread_released": False
-    }
+    acquired = threading.Event()
+    released = threading.Event()
 
     def wait_for_expire():
         """Wait until the key is expire and acquire then"""
         mtx.acquire()
-        checks["thread_acquired"] = True
+        acquired.set()
         mtx.release()
-        checks["thread_released"] = True
+        released.set()
 
     thr = threading.Thread(target=wait_for_expire)
     thr.start()
 
-    # Key expires in 1 second, wait for it.
-    time.sleep(1.5)
+    # Key expires in 1 second, the thread should get it then.
+    assert acquired.wait(5)
+    assert released.wait(1)
+
+    # Our own lock is gone, so this does nothing.
     mtx.release()
-    thr.join(0.1)
+    thr.join()
 
     assert fake_redis.get('dum-dum') is None
-    assert checks["thread_acquired"]
-    assert checks["thread_released"]
+
+
+@pytest.mark.unittest
+def test_acquire_notified_on_release(fake_redis, monkeypatch):
+    """Test if a waiting thread wakes up as soon as the lock is released"""
+    # Make polling so slow that only the notification can wake it up in time.
+    monkeypatch.setattr("redicts.lock._MIN_WAIT_SECONDS", 5)
+    monkeypatch.setattr("redicts.lock._MAX_WAIT_SECONDS", 5)
+
+    mtx = Lock(fake_redis, 'dum-dum')
+
+    checks = {
+        "acquired_at": None
+    }
+
+    def _wait_for_release():
+        """Block until the main thread releases the lock"""
+        with mtx:
+            checks["acquired_at"] = time.monotonic()
+
+    mtx.acquire()
+    thr = threading.Thread(target=_wait_for_release)
+    thr.start()
+
+    # Give the thread enough time to start waiting.
+    time.sleep(0.5)
+    released_at = time.monotonic()
+    mtx.release()
+    thr.join(15)
+
+    assert checks["acquired_at"] is not None
+    assert checks["acquired_at"] - released_at < 1
+
+
+@pytest.mark.unittest
+def test_acquire_waiters_share_subscription(fake_redis, monkeypatch):
+    """All waiting threads share one subscription to release notifications"""
+    monkeypatch.setattr("redicts.lock._MIN_WAIT_SECONDS", 5)
+    monkeypatch.setattr("redicts.lock._MAX_WAIT_SECONDS", 5)
+
+    pubsubs = []
+    real_pubsub = fake_redis.pubsub
+
+    def _counting_pubsub(**kwargs):
+        """Remember each subscription that gets created"""
+        pubsubs.append(real_pubsub(**kwargs))
+        return pubsubs[-1]
+
+    monkeypatch.setattr(fake_redis, "pubsub", _counting_pubsub)
+
+    mtx = Lock(fake_redis, 'dum-dum')
+    acquired = []
+
+    def _wait_for_release():
+        """Block until the main thread releases the lock"""
+        with mtx:
+            acquired.append(threading.get_ident())
+
+    mtx.acquire()
+    threads = [threading.Thread(target=_wait_for_release) for _ in range(5)]
+    for thr in threads:
+        thr.start()
+
+    time.sleep(0.5)
+    assert not acquired
+
+    started_at = time.monotonic()
+    mtx.release()
+    for thr in threads:
+        thr.join(15)
+
+    assert len(acquired) == 5
+    assert time.monotonic() - started_at < 2.5
+    assert len(pubsubs) == 1
+
+
+@pytest.mark.unittest
+def test_bad_lock_token(fake_redis):
+    """Test if tampering with the lock key is detected"""
+    mtx = Lock(fake_redis, 'dum-dum')
+    fake_redis.set('dum-dum', 'garbage')
+
+    with pytest.raises(InternalError):
+        mtx.acquire()
+
+    with pytest.raises(InternalError):
+        mtx.release()
+
+
+@pytest.mark.unittest
+def test_multi_lock(fake_redis):
+    """Test if many keys can be locked and released at once"""
+    mtx = MultiLock(fake_redis, ['a.b', 'a.b.c', 'x'])
+    assert not mtx.is_locked()
+
+    with mtx:
+        assert Lock(fake_redis, 'a.b.c.d').is_locked()
+        assert Lock(fake_redis, 'x').is_locked()
+        assert not Lock(fake_redis, 'y').is_locked()
+
+        # a.b.c got added to the lock on a.b:
+        assert fake_redis.get('a.b.c') is None
+
+    assert not mtx.is_locked()
+    assert fake_redis.get('a.b') is None
+
+
+@pytest.mark.unittest
+def test_multi_lock_all_or_nothing(fake_redis):
+    """Test if nothing is locked when one of the keys is taken"""
+    # Pretend some other process holds this one:
+    fake_redis.set('y', '1:1:1')
+
+    mtx = MultiLock(fake_redis, ['x', 'y'], acquire_timeout=1)
+    with pytest.raises(LockTimeout):
+        mtx.acquire()
+
+    assert fake_redis.get('x') is None
+
+
+@pytest.mark.unittest
+def test_release_foreign_lock(fake_redis):
+    """Test if releasing does not touch a lock held by someone else"""
+    mtx = Lock(fake_redis, 'dum-dum')
+
+    # Pretend our lock expired and some other process took it over:
+    fake_redis.set('dum-dum', '1:1:1')
+    mtx.release()
+    assert fake_redis.get('dum-dum') == '1:1:1'
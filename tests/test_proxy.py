@@ -7,14 +7,15 @@ No integration tests (i.e. real redis server) allowed here.
 """
 
 # Stdlib:
-import time
 import threading
 
 # External:
 import pytest
+import redis
+import fakeredis
 
 # Internal:
-from redicts import Proxy, root, section
+from redicts import Pool, Proxy, root, section
 
 
 # pylint: disable=no-self-use,attribute-defined-outside-init,unused-argument
@@ -74,26 +75,35 @@ def test_recursive_local_lock(fake_redis):
     root_prox = Proxy(path=('QualityControl',))
     root_prox.clear()
 
-    thread_died_yet = False
+    releasing = threading.Event()
+    acquired = threading.Event()
+    checks = {
+        "acquired_after_release": False
+    }
 
     def _lock_in_thread():
         """The root_prox lock shoud block until it was released"""
         with root_prox:
-            # This timeout here is to make sure thread_died_yet was set.
-            time.sleep(0.05)
-            assert thread_died_yet
+            checks["acquired_after_release"] = releasing.is_set()
+            acquired.set()
 
     with root_prox:
+        # This should work for the same thread:
+        with root_prox:
+            pass
+
         # Spin up a thread and see if it blocks as expected.
         thr = threading.Thread(target=_lock_in_thread)
         thr.start()
-        thr.join(0.25)
+        assert not acquired.wait(0.25)
 
         # This flag is needed since _lock_in_thread will (rightfully)
         # acquire the lock once this context manager left.
-        thread_died_yet = True
+        releasing.set()
 
-    time.sleep(0.5)
+    assert acquired.wait(5)
+    thr.join()
+    assert checks["acquired_after_release"]
 
 
 def test_root_proxy(fake_redis):
@@ -137,41 +147,32 @@ def test_nested_locking(fake_redis):
     sec['a.b'].acquire()
     sec['a.b.c'].acquire()
 
-    checks = {
-        "thread-died": False
-    }
+    acquired = threading.Event()
 
     def _lock_me_dead():
-        """This should block, so thread_died_yet should be True
-        since it's set after the join timeout.
-        """
+        """This should block until both locks above were released."""
         with sec['a.b.c.d']:
-            time.sleep(0.05)
-
-        checks["thread-died"] = True
+            acquired.set()
 
     thr = threading.Thread(target=_lock_me_dead)
     thr.start()
-    thr.join(0.5)
 
-    # If the lock would not block, the join would give the thread
-    # enough time to set the flag.
-    assert checks['thread-died'] is False
+    # If the lock would not block, the thread would have
+    # enough time to acquire it.
+    assert not acquired.wait(0.5)
 
     # Release the top node.
     sec['a.b'].release()
 
     # Thread should still not be able to acquire the lock
     # since a.b.c was locked (which locked a.b in turn)
-    assert checks['thread-died'] is False
-    time.sleep(0.1)
-    assert checks['thread-died'] is False
+    assert not acquired.wait(0.1)
 
     sec['a.b.c'].release()
 
     # Now finally the thread should be able to acquire the lock.
-    time.sleep(0.5)
-    assert checks['thread-died'] is True
+    assert acquired.wait(5)
+    thr.join()
 
 
 @pytest.mark.unittest
@@ -183,13 +184,22 @@ def test_sequential_lock(fake_redis):
     locked_val = Proxy('LockMe').set("x", 0)
     for _ in range(1000):
         with locked_val:
-            locked_val.set("x", locked_val.get("x").val() + 1)
+            # add() is a single INCRBY, no GET and SET needed.
+            locked_val.get("x").add(1)
+
+    assert locked_val.get("x").val() == 1000
+    assert not locked_val.is_locked()
 
 
 @pytest.mark.unittest
 def test_same_reference(fake_redis):
     """Test if the same reference is returned for the same proxy path."""
     assert Proxy("x") is Proxy("x")
+    assert Proxy("x.y") is Proxy(("x", "y")) is root()["x"]["y"]
+    assert Proxy("x")["y.z"] is Proxy("x.y.z")
+
+    with pytest.raises(ValueError):
+        Proxy("x").get("y..z")
     assert Proxy("x") is not Proxy("y")
 
 
@@ -202,6 +212,13 @@ def test_if_equal(fake_redis):
     assert Proxy("section.x") == Proxy("section.y")
     Proxy("section").set("y", 2)
     assert Proxy("section.x") != Proxy("section.y")
+    assert Proxy("section.x") < Proxy("section.y")
+
+    # Nested values are compared as dicts:
+    Proxy("section").set("z", {"a": 1})
+    Proxy("section").set("w", {"a": 1})
+    assert Proxy("section.z") == Proxy("section.w")
+    assert Proxy("section.z") != Proxy("section.x")
 
 
 @pytest.mark.unittest
@@ -231,14 +248,17 @@ def test_iter_children(fake_redis):
     sec = section("dummy")
     sec.clear()
 
-    sec.set("a.b.c", 2)
-    sec.set("a.b.d", 3)
+    sec.set_many({"a.b.c": 2, "a.b.d": 3})
 
     children = [(prx.key(), prx.val()) for prx in sec.iter_children()]
 
     assert children == [('dummy.a.b.c', 2), ('dummy.a.b.d', 3)]
-    assert fake_redis.get('v:.dummy.a.b.c') == b'2'
-    assert fake_redis.get('v:.dummy.a.b.d') == b'3'
+
+    items = [(prx.key(), val) for prx, val in sec.iter_items()]
+    assert items == children
+    assert list(sec["a.b.c"].iter_items()) == []
+    assert fake_redis.get('v:.dummy.a.b.c') == '2'
+    assert fake_redis.get('v:.dummy.a.b.d') == '3'
 
 
 @pytest.mark.unittest
@@ -253,6 +273,51 @@ def test_add(fake_redis):
     sec.get("x").add(1)
     assert sec.get("x").val() == 2
 
+    assert sec.get("x").add(0.5) == 2.5
+    assert sec.get("x").val() == 2.5
+    assert sec.get("x").add(1) == 3.5
+
+    sec["y"] = "not a number"
+    with pytest.raises(ValueError):
+        sec.get("y").add(1)
+
+    # Whole results of a float addition have to stay floats:
+    assert sec.get("x").add(0.5) == 4
+    assert isinstance(sec.get("x").val(), float)
+
+    # Adding to a nested value may not hide its children:
+    sec["z"] = {"a": 1}
+    with pytest.raises(TypeError):
+        sec.get("z").add(1)
+
+    assert sec.get("z").val() == {"a": 1}
+
+
+@pytest.mark.unittest
+def test_add_overflow(fake_redis, monkeypatch):
+    """Integers that overflow on the server may not turn into floats"""
+    def _overflowing_incrby(*_args):
+        """fakeredis does not check for overflows, unlike redis"""
+        raise redis.ResponseError("increment or decrement would overflow")
+
+    monkeypatch.setattr(
+        fakeredis.FakeStrictRedis, "incrby", _overflowing_incrby
+    )
+
+    sec = section("dummy")
+    sec.clear()
+
+    sec["x"] = 2 ** 63 - 1
+    with pytest.raises(ValueError):
+        sec.get("x").add(1)
+
+    assert sec.get("x").val() == 2 ** 63 - 1
+    assert isinstance(sec.get("x").val(), int)
+
+    # Stored floats still work (INCRBY fails for them as well):
+    sec["y"] = 1.5
+    assert sec.get("y").add(1) == 2.5
+
 
 @pytest.mark.unittest
 def test_val_default(fake_redis):
@@ -283,3 +348,105 @@ def test_timeout(fake_redis):
     assert sec._redis_lock._acquire_seconds == 10
     # pylint: disable=protected-access
     assert sec._redis_lock._expire_seconds == 30
+
+
+@pytest.mark.unittest
+def test_expire_and_clear(fake_redis):
+    """See if expire() and clear() reach all children"""
+    sec = section("dummy")
+    sec.clear()
+
+    sec.set("a", {"b": 1, "c": {"d": 2}})
+    sec["a"].expire(10)
+    assert 0 < fake_redis.ttl('v:.dummy.a.b') <= 10
+    assert 0 < fake_redis.ttl('v:.dummy.a.c.d') <= 10
+
+    sec.clear()
+    assert sec.val() is None
+    assert fake_redis.keys('v:.dummy*') == []
+
+
+@pytest.mark.unittest
+def test_set_expire(fake_redis):
+    """See if set() passes the expire time to every child"""
+    sec = section("dummy")
+    sec.clear()
+
+    sec.set("a", {"b": 1, "c": {"d": 2}}, expire=10)
+    assert sec["a"].val() == {"b": 1, "c": {"d": 2}}
+    assert 0 < fake_redis.ttl('v:.dummy.a.b') <= 10
+    assert 0 < fake_redis.ttl('v:.dummy.a.c.d') <= 10
+
+
+@pytest.mark.unittest
+def test_len(fake_redis):
+    """See if len() counts direct children or the scalar value"""
+    sec = section("dummy")
+    sec.clear()
+
+    sec["a"] = {"b": {"c": 1, "d": 2}, "e": [1, 2, 3]}
+    assert len(sec) == 1
+    assert len(sec["a"]) == 2
+    assert len(sec["a.b"]) == 2
+    assert len(sec["a.e"]) == 3
+
+    with pytest.raises(TypeError):
+        len(sec["x"])
+
+
+@pytest.mark.unittest
+def test_many_scan_calls(fake_redis, monkeypatch):
+    """Values spread over many SCAN calls are read completely"""
+    monkeypatch.setattr("redicts.proxy.SCAN_COUNT", 3)
+
+    sec = section("many")
+    sec.clear()
+
+    values = {str(idx): idx for idx in range(10)}
+    sec["x"] = values
+    assert sec["x"].val() == values
+    assert len(sec["x"]) == 10
+    assert len(list(sec["x"].iter_children())) == 10
+
+
+@pytest.mark.unittest
+def test_set_many(fake_redis):
+    """See if setting several keys at once works like single sets"""
+    sec = section("many")
+    sec.clear()
+
+    sec["a"] = 1
+    sec["b"] = {"old": 1}
+
+    assert sec.set_many({"a.x": 2, "b": {"y": 3}, "c": None}) is sec
+    assert sec.val() == {"a": {"x": 2}, "b": {"y": 3}, "c": None}
+
+    # Nothing may change if one of the keys is invalid:
+    with pytest.raises(ValueError):
+        sec.set_many({"b": {"z": 4}, "bad..key": 5})
+
+    with pytest.raises(ValueError):
+        sec.set_many({"b": {"z": 4}, "c": {1: 5}})
+
+    assert sec.val() == {"a": {"x": 2}, "b": {"y": 3}, "c": None}
+
+    sec.set_many({"d": 4, "e": {"f": 5}}, expire=10)
+    assert 0 < sec["d"].time_to_live() <= 10
+    assert 0 < sec["e"].time_to_live() <= 10
+    assert sec["a"].time_to_live() < 0
+
+
+@pytest.mark.unittest
+def test_lock_follows_pool_reload(fake_redis):
+    """The lock of a proxy has to use the new connection after a reload"""
+    sec = section("reload")
+    # pylint: disable=protected-access
+    old_lock = sec._redis_lock
+    assert sec._redis_lock is old_lock
+
+    Pool().reload(fake_redis=True)
+
+    # pylint: disable=protected-access
+    assert sec._redis_lock is not old_lock
+    # pylint: disable=protected-access
+    assert sec._redis_lock._redis_conn is sec._conn()
@@ -10,12 +10,10 @@ Only execute those if you have a running redis instance.
 
 
 # Stdlib:
-import time
 import contextlib
 
-from threading import Thread, Semaphore
-from collections import defaultdict
-from multiprocessing import Process
+from threading import Barrier, Event, Thread
+from multiprocessing import Pool as ProcessPool
 
 # External:
 import pytest
@@ -24,43 +22,54 @@ import pytest
 from redicts import Proxy, Pool
 
 
-class Barrier(object):
-    """
-    This is about the same as python3's barrier primitive,
-    but simulated using Semaphores.
-    """
-    def __init__(self, height):
-        self.height, self.count = height, 0
-        self.mutex, self.barrier = Semaphore(1), Semaphore(0)
+@pytest.fixture(scope="module")
+def worker_procs():
+    """Worker processes, started once and shared by all tests here"""
+    # The workers inherit the pool on fork, so it has to talk to the real
+    # redis by then. They may not reload it themselves: that would
+    # disconnect the sockets they share with this process. redis-py opens
+    # new connections in a forked process anyway.
+    Pool().reload(fake_redis=False)
+    procs = ProcessPool(processes=3)
+    yield procs
+    procs.close()
+    procs.join()
 
-    def wait(self):
-        """Wait until the barrier height is reached"""
-        self.mutex.acquire()
-        self.count += 1
-        self.mutex.release()
 
-        if self.count == self.height:
-            self.barrier.release()
+@contextlib.contextmanager
+def background_proc(procs, target, args, jobs=1):
+    """Run the callable target `jobs` times in the worker processes `procs`
+    and pass `args` to it. After those were started, execute the code in the
+    with statement. `target` has to be picklable (i.e. module level).
+    """
+    results = [procs.apply_async(target, args) for _ in range(jobs)]
+
+    yield
 
-        self.barrier.acquire()
-        self.barrier.release()
+    # Also re-raises errors that happened in the worker.
+    for result in results:
+        result.get()
 
 
-@contextlib.contextmanager
-def background_proc(target, args, jobs=1):
-    """Start the callable target in `jobs` processes and pass `args` to it
-    After those were started, execute the code in the with statement.
+def _many_increments(n_increments):
+    """Make a lot of individually locked increments.
+    In practice you should of course do the lock around the for loop
+    to reduce lock contention, but here we want to trigger races.
     """
-    procs = []
-    for _ in range(jobs):
-        proc = Process(target=target, args=args)
-        proc.start()
-        procs.append(proc)
+    # Note: Every process needs it's own lock.
+    # Obvious, but easy to forget in unittests.
+    proxy = Proxy(['QC'])
+    counter = proxy.get("x")
+    for _ in range(n_increments):
+        with proxy:
+            proxy.set("x", counter.val() + 1)
 
-    yield
 
-    for proc in procs:
-        proc.join()
+def _many_adds(n_increments):
+    """Make a lot of unlocked increments"""
+    counter = Proxy(['QC']).get("x")
+    for _ in range(n_increments):
+        counter.add(1)
 
 
 @contextlib.contextmanager
@@ -85,62 +94,75 @@ def test_parallel_lock(real_redis):
     """Test if two processes really block on a common ressource"""
     val = Proxy('LockMe').set("x", 0)
 
-    checks = defaultdict(bool)
+    locked, acquired = Event(), Event()
 
     def _lock_me():
         """See if the thread could acquire the lock at last"""
-        time.sleep(0.5)
+        locked.wait()
         val.acquire()
+        acquired.set()
         val.release()
-        checks["thread-got-through"] = True
 
     jobs = 2
     with background_thread(_lock_me, (), jobs=jobs - 1):
         val.acquire()
-        time.sleep(2)
+        locked.set()
+
+        # The thread has to wait for us:
+        assert not acquired.wait(0.5)
         val.release()
-        time.sleep(0.5)
 
-    assert checks["thread-got-through"]
+    assert acquired.is_set()
 
 
 @pytest.mark.integration
-def test_parallel_proxy_sets(real_redis):
+def test_parallel_proxy_sets(real_redis, worker_procs):
     """Test many parallel sets from more than one process."""
 
     Proxy(['QC']).set("x", 0)
     n_increments = 1000
     jobs = 4
+    args = (n_increments, )
 
-    def _many_increments():
-        """Make a lot of individually locked increments.
-        In practice you should of course do the lock around the for loop
-        to reduce lock contention, but here we want to trigger races.
-        """
-        # Note: Every process needs it's own lock.
-        # Obvious, but easy to forget in unittests.
-        proxy = Proxy(['QC'])
-        for _ in range(n_increments):
-            with proxy:
-                proxy.set("x", proxy.get("x").val() + 1)
-
-    with background_thread(_many_increments, (), jobs=jobs - 1):
+    with background_thread(_many_increments, args, jobs=jobs - 1):
         # This code runs in the foreground:
-        _many_increments()
+        _many_increments(n_increments)
 
     # See if really all increments got counted.
     assert Proxy(['QC']).get("x").val() == jobs * n_increments
 
     # Reset and see if it also works for mutliple processes
     Proxy(['QC']).set("x", 0)
-    with background_proc(_many_increments, (), jobs=jobs - 1):
+    with background_proc(worker_procs, _many_increments, args, jobs=jobs - 1):
         # This code runs in the foreground:
-        _many_increments()
+        _many_increments(n_increments)
 
     # See if really all increments got counted.
     assert Proxy(['QC']).get("x").val() == jobs * n_increments
 
 
+@pytest.mark.integration
+def test_parallel_proxy_adds(real_redis, worker_procs):
+    """Same as test_parallel_proxy_sets, but with add() instead of a lock.
+    add() increments on the server, so no increment may get lost.
+    """
+    Proxy(['QC']).set("x", 0)
+    n_increments = 1000
+    jobs = 4
+    args = (n_increments, )
+
+    with background_thread(_many_adds, args, jobs=jobs - 1):
+        _many_adds(n_increments)
+
+    assert Proxy(['QC']).get("x").val() == jobs * n_increments
+
+    Proxy(['QC']).set("x", 0)
+    with background_proc(worker_procs, _many_adds, args, jobs=jobs - 1):
+        _many_adds(n_increments)
+
+    assert Proxy(['QC']).get("x").val() == jobs * n_increments
+
+
 @pytest.mark.integration
 def test_alternative_db(real_redis):
     """Test if we can set different values for the same key in different
@@ -202,10 +224,21 @@ def test_many_open_connections(real_redis):
         # at the same time for all threads.
         barrier.wait()
 
-        for _ in range(100):
-            assert prox["url"].exists()
-            assert prox.val() == {"url": "https://..."}
-            assert prox["url"].val() == "https://..."
+        assert prox["url"].exists()
+        assert prox.val() == {"url": "https://..."}
+        assert prox["url"].val() == "https://..."
+
+        # Keep the connection busy for a while, but without paying a round
+        # trip for every single command.
+        n_rounds = 100
+        with Pool().get_connection().pipeline(transaction=False) as pipe:
+            for _ in range(n_rounds):
+                pipe.exists("v:.ImageCache.url")
+                pipe.get("v:.ImageCache.url")
+
+            results = pipe.execute()
+
+        assert results == [True, '"https://..."'] * n_rounds
 
     with background_thread(_use_me, (), jobs=n_threads-1):
         # Just use the main thread as one extra worker (thus -1)
@@ -238,9 +271,8 @@ def test_recursive_lock_expire(real_redis):
 
     prox._redis_lock.release()
 
-    assert conn.ttl("l:.lock-test") == 15
-    time.sleep(1)
-    assert conn.ttl("l:.lock-test") == 14
+    # A lock without expire time would have a negative ttl:
+    assert 0 < conn.pttl("l:.lock-test") <= 15000
 
     prox._redis_lock.release()
 
@@ -5,12 +5,23 @@
 Test the key related utils.
 """
 
+# Stdlib:
+import importlib
+import json
+import math
+import sys
+import timeit
+
 # External:
 import pytest
 
 # Internal:
 from redicts.util import \
-    extract_keys, feed_to_nested, validate_key, parse_lock_token, InternalError
+    extract_keys, feed_to_nested, validate_key, parse_lock_token, \
+    iter_batches, build_key_hierarchy, InternalError
+import redicts._compat
+
+from redicts._compat import json_dumps, json_loads
 
 
 SAMPLE_DATA = {
@@ -41,6 +52,14 @@ def test_extract_keys():
     key_values = set(extract_keys(SAMPLE_DATA))
     assert key_values == FLATTENED_DATA
 
+    # Order of keys should be kept:
+    assert [key for key, _ in extract_keys(SAMPLE_DATA, "x")] == [
+        "x.a.b", "x.a.c.d", "x.a.c.e.f", "x.g"
+    ]
+
+    with pytest.raises(ValueError):
+        list(extract_keys({"a": {1: 2}}))
+
 
 @pytest.mark.unittest
 def test_feed_to_nested():
@@ -71,7 +90,14 @@ def test_validate_key():
     with pytest.raises(ValueError):
         validate_key("a..b")
 
+    # Invalid keys keep failing, also when asked again:
+    with pytest.raises(ValueError):
+        validate_key("a..b")
+
+    validate_key("a.b")
     validate_key("a.b")
+    validate_key("a")
+    validate_key("ä.b c.\n")
 
 
 @pytest.mark.unittest
@@ -84,3 +110,79 @@ def test_parse_lock_token():
 
     with pytest.raises(InternalError):
         parse_lock_token("1:2")
+
+
+@pytest.mark.unittest
+def test_iter_batches():
+    """See if splitting into batches keeps all elements in order"""
+    assert list(iter_batches([], 2)) == []
+    assert list(iter_batches(range(4), 2)) == [[0, 1], [2, 3]]
+    assert list(iter_batches(range(5), 2)) == [[0, 1], [2, 3], [4]]
+
+
+@pytest.mark.unittest
+def test_build_key_hierarchy():
+    """See if all parents of a key are found, nearest first"""
+    assert build_key_hierarchy("a") == ["a"]
+    assert build_key_hierarchy("a.b.c") == ["a.b.c", "a.b", "a"]
+    assert build_key_hierarchy("l:.x") == ["l:.x", "l:"]
+
+
+@pytest.fixture(params=["orjson", "json"])
+def compat(request, monkeypatch):
+    """redicts._compat, once with and once without orjson"""
+    if request.param == "orjson":
+        pytest.importorskip("orjson")
+    else:
+        monkeypatch.setitem(sys.modules, "orjson", None)
+
+    yield importlib.reload(redicts._compat)
+
+    monkeypatch.undo()
+    importlib.reload(redicts._compat)
+
+
+@pytest.mark.unittest
+def test_json_roundtrip(compat):
+    """See if values survive (de)serialization with the right type"""
+    for value in [0, 42, -1, 2 ** 63 - 1, 2 ** 64, -2 ** 63 - 1, 2 ** 70,
+                  1.5, float('inf'), True, False, None, "12", "",
+                  [1, "2", 2 ** 64], {"a": {"b": None}}]:
+        loaded = compat.json_loads(compat.json_dumps(value))
+        assert loaded == value
+        assert type(loaded) is type(value)
+
+    assert math.isnan(compat.json_loads(compat.json_dumps(float('nan'))))
+
+    # Only ASCII digits are numbers in JSON:
+    for invalid in ["\u00b2", "\u0663"]:
+        with pytest.raises(ValueError):
+            compat.json_loads(invalid)
+
+    # Values read from a connection without decode_responses:
+    assert compat.json_loads(b"42") == 42
+    assert compat.json_loads(b'{"a": [1.5]}') == {"a": [1.5]}
+
+
+@pytest.mark.unittest
+def test_json_orjson_faster_than_json():
+    """The checks around orjson may not eat up what it saves"""
+    pytest.importorskip("orjson")
+
+    records = {
+        str(idx): {"id": idx, "name": "r" + str(idx), "n": None, "x": [1.5]}
+        for idx in range(200)
+    }
+
+    for value in [list(range(1000)), records]:
+        encoded = json.dumps(value)
+        for ours, stdlib, arg in [
+                (json_dumps, json.dumps, value),
+                (json_loads, json.loads, encoded)]:
+            ours_time = min(timeit.repeat(
+                lambda: ours(arg), number=100, repeat=3
+            ))
+            stdlib_time = min(timeit.repeat(
+                lambda: stdlib(arg), number=100, repeat=3
+            ))
+            assert ours_time < stdlib_time